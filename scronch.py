@@ -12,7 +12,7 @@ from gi.repository import Gimp
 from gi.repository import GLib, GObject
 from gi.repository import Gio 
 import os
-import datetime
+import time
 import logging
 
 # ============================================================================
@@ -21,18 +21,18 @@ import logging
 
 # AVIF Export Settings
 AVIF_QUALITY = 85                   # Quality factor (0 = worst, 100 = best) (0 <= quality <= 100, default 50)
-AVIF_LOSSLESS = True                # Use lossless compression (TRUE or FALSE, default FALSE)
-AVIF_BIT_DEPTH = 10                 # 8, 10, or 12 bits per channel
-AVIF_PIXEL_FORMAT = "yuv444"        # "rgb", "yuv444" (best quality), "yuv420" (smaller)
-AVIF_ENCODER_SPEED = "balanced"     # "slow" (best compression), "balanced", "fast"
-AVIF_INCLUDE_EXIF = True            # Include EXIF metadata
-AVIF_INCLUDE_XMP = True             # Include XMP metadata
+AVIF_LOSSLESS = False               # Use lossless compression (TRUE or FALSE, default FALSE). Much slower and larger; ignores quality and pixel format
+AVIF_BIT_DEPTH = 8                  # 8, 10, or 12 bits per channel (8 is raised to 10 for 16/32-bit images)
+AVIF_PIXEL_FORMAT = "yuv420"        # "rgb", "yuv444" (best quality), "yuv420" (smaller, faster to encode)
+AVIF_ENCODER_SPEED = "fast"         # "slow" (best compression), "balanced", "fast" (several times quicker, slightly larger/lower quality files)
+AVIF_INCLUDE_EXIF = False           # Include EXIF metadata (off by default: may leak GPS location, camera serials, etc.)
+AVIF_INCLUDE_XMP = False            # Include XMP metadata (off by default for the same privacy reasons)
 
 # PNG Export Settings (fallback)
-PNG_COMPRESSION = 9                 # Deflate Compression factor (0..9) (0 <= compression <= 9, default 9)
+PNG_COMPRESSION = 3                 # Deflate Compression factor (0..9) (0 <= compression <= 9, default 9). Higher is much slower for little size gain
 PNG_INTERLACED = False              # Use Adam7 interlacing (TRUE or FALSE, default FALSE)
 PNG_SAVE_TRANSPARENT = True         # Preserve color of completely transparent pixels (TRUE or FALSE, default FALSE)
-PNG_OPTIMIZE_PALETTE = False        # When checked, save as 1, 2, 4, or 8-bit depending on number of colors used. When unchecked, always save as 8-bit (TRUE or FALSE, default FALSE)
+PNG_OPTIMIZE_PALETTE = True         # When checked, save as 1, 2, 4, or 8-bit depending on number of colors used. When unchecked, always save as 8-bit (TRUE or FALSE, default FALSE)
 PNG_FORMAT = "auto"                 # Allowed values: auto: Automatic, rgb8: 8 bpc RGB, gray8: 8 bpc GRAY, rgba8: 8 bpc RGBA, graya8: 8 bpc GRAYA, rgb16: 16 bpc RGB,gray16: 16 bpc GRAY, rgba16: 16 bpc RGBA, graya16: 16 bpc GRAYA
 
 # General Settings
@@ -41,6 +41,20 @@ TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"   # Timestamp format for filename
 
 # ============================================================================
 
+# Fail fast on a bad setting instead of after the image has been copied
+if not 0 <= AVIF_QUALITY <= 100:
+    raise ValueError("AVIF_QUALITY must be between 0 and 100")
+if AVIF_BIT_DEPTH not in (8, 10, 12):
+    raise ValueError("AVIF_BIT_DEPTH must be 8, 10, or 12")
+if AVIF_PIXEL_FORMAT not in ("rgb", "yuv444", "yuv420"):
+    raise ValueError("AVIF_PIXEL_FORMAT must be rgb, yuv444, or yuv420")
+if AVIF_ENCODER_SPEED not in ("slow", "balanced", "fast"):
+    raise ValueError("AVIF_ENCODER_SPEED must be slow, balanced, or fast")
+if not 0 <= PNG_COMPRESSION <= 9:
+    raise ValueError("PNG_COMPRESSION must be between 0 and 9")
+if PNG_FORMAT not in ("auto", "rgb8", "gray8", "rgba8", "graya8", "rgb16", "gray16", "rgba16", "graya16"):
+    raise ValueError("PNG_FORMAT must be one of the values listed next to it")
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -48,6 +62,144 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Export procedure and its file extension, resolved once per plug-in process
+_EXPORT_PROC = None
+_EFFECTIVE_FORMAT = None
+
+# GI enum values resolved once instead of on every run
+_RUNMODE_NONINT = Gimp.RunMode.NONINTERACTIVE
+_STATUS_OK = Gimp.PDBStatusType.SUCCESS
+_STATUS_ERR = Gimp.PDBStatusType.EXECUTION_ERROR
+
+# Export settings that stay the same from run to run
+_AVIF_PROPERTIES = {
+    "run-mode": _RUNMODE_NONINT,
+    "options": None,
+    "lossless": AVIF_LOSSLESS,
+    "pixel-format": AVIF_PIXEL_FORMAT,
+    "encoder-speed": AVIF_ENCODER_SPEED,
+    "include-exif": AVIF_INCLUDE_EXIF,
+    "include-xmp": AVIF_INCLUDE_XMP,
+}
+if AVIF_LOSSLESS:
+    # Quality is ignored in lossless mode, and chroma must not be subsampled
+    # ("rgb" is the only bit-exact choice)
+    if AVIF_PIXEL_FORMAT == "yuv420":
+        _AVIF_PROPERTIES["pixel-format"] = "yuv444"
+else:
+    _AVIF_PROPERTIES["quality"] = AVIF_QUALITY
+
+_PNG_PROPERTIES = {
+    "run-mode": _RUNMODE_NONINT,
+    "options": None,
+    "interlaced": PNG_INTERLACED,
+    "compression": PNG_COMPRESSION,
+    "bkgd": True,
+    "offs": False,
+    "phys": True,
+    "time": True,
+    "save-transparent": PNG_SAVE_TRANSPARENT,
+    "optimize-palette": PNG_OPTIMIZE_PALETTE,
+    "format": PNG_FORMAT,
+}
+
+def _resolve_export_procedure():
+    """Look up the export procedure to use and return (procedure, extension)."""
+    global _EXPORT_PROC, _EFFECTIVE_FORMAT
+    if _EXPORT_PROC is None:
+        pdb = Gimp.get_pdb()
+        # Try AVIF first if preferred, otherwise use PNG
+        export_proc = pdb.lookup_procedure("file-heif-av1-export") if PREFER_AVIF else None
+        if export_proc:
+            _EFFECTIVE_FORMAT = "avif"
+        else:
+            if PREFER_AVIF:
+                logger.warning("AVIF export not available, falling back to PNG")
+            export_proc = pdb.lookup_procedure("file-png-export")
+            _EFFECTIVE_FORMAT = "png"
+        if not export_proc:
+            raise RuntimeError("No suitable export procedure found.")
+        _EXPORT_PROC = export_proc
+    return _EXPORT_PROC, _EFFECTIVE_FORMAT
+
+# Color components per base type, checked for visibility in the projection
+_COMPONENTS = {
+    Gimp.ImageBaseType.RGB: (Gimp.ChannelType.RED, Gimp.ChannelType.GREEN,
+                             Gimp.ChannelType.BLUE, Gimp.ChannelType.ALPHA),
+    Gimp.ImageBaseType.GRAY: (Gimp.ChannelType.GRAY, Gimp.ChannelType.ALPHA),
+}
+
+def _is_plain_full_layer(image, layer, base_type):
+    """Return True if the layer's pixels are exactly the image's projection.
+
+    Cheap geometry checks come first, since every call is a PDB round trip.
+    """
+    if not layer.get_visible():
+        return False
+    if layer.get_width() != image.get_width() or layer.get_height() != image.get_height():
+        return False
+    _, offset_x, offset_y = layer.get_offsets()
+    if offset_x != 0 or offset_y != 0:
+        return False
+    components = _COMPONENTS.get(base_type)
+    if components is None:
+        # Indexed: the copied layer would need the source colormap
+        return False
+    return (
+        not layer.is_group()
+        and layer.get_mask() is None
+        and layer.get_opacity() == 100.0
+        and layer.get_mode() == Gimp.LayerMode.NORMAL
+        and not layer.get_filters()
+        and all(image.get_component_visible(c) for c in components)
+    )
+
+def _render_scratch_image(image, layers):
+    """Return a new single-layer image holding the image's visible projection."""
+    # The flattened projection is RGB or GRAY, never indexed
+    source_type = image.get_base_type()
+    base_type = source_type
+    if base_type == Gimp.ImageBaseType.INDEXED:
+        base_type = Gimp.ImageBaseType.RGB
+    dup_img = Gimp.Image.new_with_precision(
+        image.get_width(),
+        image.get_height(),
+        base_type,
+        image.get_precision(),
+    )
+
+    # Carry over what image.duplicate() used to keep
+    _, xres, yres = image.get_resolution()
+    dup_img.set_resolution(xres, yres)
+    profile = image.get_color_profile()
+    if profile:
+        dup_img.set_color_profile(profile)
+    metadata = image.get_metadata()
+    if metadata:
+        dup_img.set_metadata(metadata)
+
+    if len(layers) == 1 and _is_plain_full_layer(image, layers[0], source_type):
+        # A lone, plain, image-sized layer already is the flat image:
+        # copy it directly and skip compositing the projection. The copy
+        # keeps the layer's own alpha state, matching the branch below.
+        flat_layer = Gimp.Layer.new_from_drawable(layers[0], dup_img)
+        strip_alpha = False
+        logger.debug("Single layer copied.")
+    else:
+        # Render the visible projection once into a fresh single-layer image
+        # (avoids copying every layer only to composite them again)
+        flat_layer = Gimp.Layer.new_from_visible(image, dup_img, "flat")
+        # new_from_visible always adds alpha; keep opaque sources opaque
+        # like merge_visible_layers did, so no alpha plane gets encoded
+        strip_alpha = not any(layer.get_visible() and layer.has_alpha() for layer in layers)
+        logger.debug("Image flattened.")
+    dup_img.insert_layer(flat_layer, None, 0)
+
+    if strip_alpha:
+        dup_img.flatten()
+        logger.debug("Alpha channel removed.")
+    return dup_img
+
 class ScronchPlugin(Gimp.PlugIn):
     def do_set_i18n(self, procname):
         return False
@@ -77,134 +229,113 @@ class ScronchPlugin(Gimp.PlugIn):
 
     def run(self, procedure, run_mode, image, drawable, parameters, run_data):
         try:
-            # Duplicate the image
-            dup_img = image.duplicate()
-            logger.debug("Image duplicated.")
+            # Resolve the export procedure first so the output extension is
+            # known up front and nothing is rendered if there is none
+            export_proc, ext = _resolve_export_procedure()
+            is_avif = ext == "avif"
 
-            # Flatten the layers in the duplicate
-            dup_img.merge_visible_layers(Gimp.MergeType.CLIP_TO_IMAGE)
-            logger.debug("Image flattened.")
+            layers = image.get_layers()
+            if image.get_quick_mask() or any(c.get_visible() for c in image.get_channels()):
+                # The projection would include the Quick Mask / channel tint,
+                # so merge only the layers of a full duplicate instead
+                dup_img = image.duplicate()
+                dup_img.merge_visible_layers(Gimp.MergeType.CLIP_TO_IMAGE)
+                logger.debug("Image duplicated and flattened.")
+            else:
+                dup_img = _render_scratch_image(image, layers)
 
-            # Determine the directory and base name for the output file
+            # Determine the directory and base name for the output file by
+            # slicing the path once rather than running it through os.path
             file_obj = image.get_file()
-            if file_obj:
-                original_filepath = file_obj.get_path()
-                if original_filepath:
-                    base_dir = os.path.dirname(original_filepath)
-                    base_filename, _ = os.path.splitext(os.path.basename(original_filepath))
+            original_filepath = file_obj.get_path() if file_obj else None
+            if original_filepath:
+                slash = original_filepath.rfind(os.sep)
+                if os.altsep:
+                    slash = max(slash, original_filepath.rfind(os.altsep))
+                dot = original_filepath.rfind('.')
+                base_dir = original_filepath[:slash] if slash >= 0 else os.getcwd()
+                if dot > slash + 1:
+                    base_filename = original_filepath[slash + 1:dot]
                 else:
-                    base_dir = os.getcwd()
-                    base_filename = "untitled"
+                    base_filename = original_filepath[slash + 1:]
             else:
                 base_dir = os.getcwd()
                 base_filename = "untitled"
 
-            # Generate the output file path (changed to .avif)
-            now = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
-            if PREFER_AVIF:
-                output_filename = os.path.join(base_dir, f"{base_filename}-{now}.avif")
-            else:
-                output_filename = os.path.join(base_dir, f"{base_filename}-{now}.png")
-            logger.debug(f"Output will be saved to: {output_filename}")
-
-            # Absolute file path for saving
-            if not os.path.isabs(output_filename):
-                output_filename = os.path.abspath(output_filename)
-
-            # Get the PDB instance and export procedure
-            pdb = Gimp.get_pdb()
-            
-            # Try AVIF first if preferred, otherwise use PNG
-            if PREFER_AVIF:
-                export_proc = pdb.lookup_procedure("file-heif-av1-export")
-                if not export_proc:
-                    logger.warning("AVIF export not available, falling back to PNG")
-                    export_proc = pdb.lookup_procedure("file-png-export")
-                    output_filename = output_filename.replace('.avif', '.png')
-            else:
-                export_proc = pdb.lookup_procedure("file-png-export")
-            
-            if not export_proc:
-                raise RuntimeError("No suitable export procedure found.")
-
-            # Create a ProcedureConfig object
-            config = export_proc.create_config()
-            logger.debug("Config object created.")
+            # Generate the output file path
+            now = time.strftime(TIMESTAMP_FORMAT)
+            output_filename = f"{base_dir}{os.sep}{base_filename}-{now}.{ext}"
+            logger.debug("Output will be saved to: %s", output_filename)
 
             # Convert filename to GFile
             gfile = Gio.File.new_for_path(output_filename)
             logger.debug("Filename converted.")
 
             # Set AVIF-specific parameters (if using AVIF export)
-            if "heif-av1" in export_proc.get_name():
-                logger.info("Setting AVIF parameters...")
-                
-                # Set the required base parameters first
-                config.set_property("run-mode", Gimp.RunMode.NONINTERACTIVE)
-                config.set_property("image", dup_img)
-                config.set_property("file", gfile)
+            if is_avif:
+                logger.debug("Setting AVIF parameters...")
                 
-                # Set AVIF-specific parameters using variables
-                config.set_property("options", None)
-                config.set_property("quality", AVIF_QUALITY)
-                config.set_property("lossless", AVIF_LOSSLESS)
-                config.set_property("save-bit-depth", AVIF_BIT_DEPTH)
-                config.set_property("pixel-format", AVIF_PIXEL_FORMAT)
-                config.set_property("encoder-speed", AVIF_ENCODER_SPEED)
-                config.set_property("include-exif", AVIF_INCLUDE_EXIF)
-                config.set_property("include-xmp", AVIF_INCLUDE_XMP)
+                # Only use the slower high bit depth path for high precision images
+                bit_depth = AVIF_BIT_DEPTH
+                if bit_depth == 8 and dup_img.get_precision() >= Gimp.Precision.U16_LINEAR:
+                    bit_depth = 10
+
+                config = export_proc.create_config()
+                config.set_properties(**_AVIF_PROPERTIES, **{
+                    "image": dup_img,
+                    "file": gfile,
+                    "save-bit-depth": bit_depth,
+                })
                 
-                logger.info(f"AVIF parameters: quality={AVIF_QUALITY}, lossless={AVIF_LOSSLESS}, "
-                           f"bit-depth={AVIF_BIT_DEPTH}, pixel-format={AVIF_PIXEL_FORMAT}, "
-                           f"speed={AVIF_ENCODER_SPEED}")
+                logger.info("AVIF parameters: quality=%s, lossless=%s, "
+                            "bit-depth=%s, pixel-format=%s, speed=%s",
+                            _AVIF_PROPERTIES.get("quality", "n/a"), AVIF_LOSSLESS, bit_depth,
+                            _AVIF_PROPERTIES["pixel-format"], AVIF_ENCODER_SPEED)
                         
             else:
                 # PNG fallback parameters using variables
-                logger.info("Using PNG export parameters...")
-                config.set_property("run-mode", Gimp.RunMode.NONINTERACTIVE)
-                config.set_property("image", dup_img)
-                config.set_property("file", gfile)
-                config.set_property("options", None)
-                config.set_property("interlaced", PNG_INTERLACED)
-                config.set_property("compression", PNG_COMPRESSION)
-                config.set_property("bkgd", True)
-                config.set_property("offs", False)
-                config.set_property("phys", True)
-                config.set_property("time", True)
-                config.set_property("save-transparent", PNG_SAVE_TRANSPARENT)
-                config.set_property("optimize-palette", PNG_OPTIMIZE_PALETTE)
-                config.set_property("format", PNG_FORMAT)
+                logger.debug("Using PNG export parameters...")
+                config = export_proc.create_config()
+                config.set_properties(**_PNG_PROPERTIES, **{
+                    "image": dup_img,
+                    "file": gfile,
+                })
                 
-                logger.info(f"PNG parameters: compression={PNG_COMPRESSION}, "
-                           f"transparent={PNG_SAVE_TRANSPARENT}, format={PNG_FORMAT}")
+                logger.info("PNG parameters: compression=%s, transparent=%s, format=%s",
+                            PNG_COMPRESSION, PNG_SAVE_TRANSPARENT, PNG_FORMAT)
 
             logger.debug("Properties set.")
 
             # Run the procedure
-            logger.info("Running export procedure...")
-            Gimp.message("Running export procedure...")
-            result = export_proc.run(config)
+            logger.debug("Running export procedure...")
+            # Show the export in the status bar progress; GIMP itself stays
+            # responsive since the encoder runs in its own plug-in process
+            Gimp.progress_init(f"Scronching to {base_filename}-{now}.{ext}")
+            try:
+                result = export_proc.run(config)
+            finally:
+                Gimp.progress_end()
             logger.debug("Export procedure run.")
-            logger.debug(f"Procedure result: {result}")
+            logger.debug("Procedure result: %s", result)
 
             # Extract status from the ValueArray
             status = result.index(0)
-            if status != Gimp.PDBStatusType.SUCCESS:
+            if status != _STATUS_OK:
                 raise RuntimeError(f"Export failed with status {status}")
             
-            logger.info(f"Exported to {output_filename}")
+            logger.debug("Exported to %s", output_filename)
             Gimp.message(f"Exported to {output_filename}")
 
             # Delete the duplicate image
             dup_img.delete()
 
             # Return success status
-            return procedure.new_return_values(Gimp.PDBStatusType.SUCCESS, None)
+            return procedure.new_return_values(_STATUS_OK, None)
 
         except Exception as e:
             # Log the error and return failure status
             Gimp.message(f"Scronch plugin error: {str(e)}")
             logger.error(f"Scronch plugin error: {str(e)}", exc_info=True)
-            return procedure.new_return_values(Gimp.PDBStatusType.EXECUTION_ERROR, None)
+            return procedure.new_return_values(_STATUS_ERR, None)
 
 Gimp.main(ScronchPlugin.__gtype__, sys.argv)
\ No newline at end of file